@@ -0,0 +1,317 @@
+"""Reprodukovatelný zátěžový test všech hlavních endpointů.
+
+Naplní databázi zadané velikosti, spustí skriptované scénáře (procházení katalogu,
+vyhledávání, vytváření objednávek, obměna API klíčů) a pro každý endpoint vypíše
+propustnost a latence p50/p99. Výsledky se ukládají do JSON, aby šlo porovnat běhy
+před a po změně.
+
+Spuštění z kořene repozitáře (aplikace běží v procesu přes ASGI transport,
+s vlastní dočasnou databází):
+    python benchmarks/load_test.py --products 20000 --output before.json
+    python benchmarks/load_test.py --products 20000 --output after.json --compare before.json
+
+Proti běžícímu serveru (např. uvicorn main:app --port 9000):
+    python benchmarks/load_test.py --url http://127.0.0.1:9000 --workloads browse search
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = ["Psaní", "Papír", "Archivace", "Kancelářská technika", "Obálky", "Lepidla", "Sešívání", "Školní potřeby"]
+WORDS = ["pero", "tužka", "sešit", "pořadač", "obálka", "lepidlo", "sešívačka", "kalkulačka", "papír", "zvýrazňovač",
+         "fix", "blok", "desky", "šanon", "razítko", "pravítko", "guma", "ořezávátko", "kancelářský", "barevný"]
+# Stavy, do kterých smí přejít nová objednávka
+ORDER_TRANSITIONS = ["processing", "cancelled"]
+
+
+# Záznam latencí po endpointech (štítek = metoda + šablona cesty)
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, label: str, latency: float, ok: bool):
+        self.latencies.setdefault(label, []).append(latency)
+        if not ok:
+            self.errors[label] = self.errors.get(label, 0) + 1
+
+    def summary(self, duration: float) -> dict:
+        result = {}
+        for label, values in sorted(self.latencies.items()):
+            ordered = sorted(values)
+            result[label] = {
+                "requests": len(ordered),
+                "errors": self.errors.get(label, 0),
+                "throughput": len(ordered) / duration if duration else 0.0,
+                "mean_ms": statistics.fmean(ordered) * 1000,
+                "p50_ms": percentile(ordered, 0.50) * 1000,
+                "p99_ms": percentile(ordered, 0.99) * 1000,
+            }
+        return result
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+# Sdílený stav běhu - klient, klíče uživatelů a ID naplněných dat
+class Context:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, products: int, users: list):
+        self.client = client
+        self.recorder = recorder
+        self.products = products
+        self.users = users  # [{"id", "email", "token", "api_key"}]
+        self.order_counter = 0
+
+    # `expected` - chybové stavy, které jsou platným výsledkem scénáře (např. 409 při vyprodaném zboží)
+    async def call(self, label: str, method: str, url: str, api_key: str = None, expected: tuple = (), **kwargs):
+        headers = kwargs.pop("headers", {})
+        if api_key:
+            headers["access_token"] = api_key
+        started = time.perf_counter()
+        response = await self.client.request(method, url, headers=headers, **kwargs)
+        self.recorder.record(label, time.perf_counter() - started,
+                             response.status_code < 400 or response.status_code in expected)
+        return response
+
+
+def product_id(index: int) -> str:
+    return f"bench-prod-{index:07d}"
+
+
+# Scénáře - jedna iterace = několik požadavků typických pro danou činnost
+async def workload_browse(ctx: Context, rng: random.Random, user: dict):
+    key = user["api_key"]
+    await ctx.call("GET /api/categories/", "GET", "/api/categories/", key)
+    category = rng.choice(CATEGORIES)
+    page = await ctx.call("GET /api/products/", "GET", "/api/products/", key,
+                          params={"category": category, "limit": 20, "skip": rng.randrange(0, 200, 20)})
+    cursor = None
+    for _ in range(2):
+        params = {"limit": 20, "cursor": cursor} if cursor else {"limit": 20, "use_cursor": True}
+        response = await ctx.call("GET /api/products/ (cursor)", "GET", "/api/products/", key, params=params)
+        cursor = response.json().get("next_cursor") if response.status_code == 200 else None
+        if not cursor:
+            break
+    products = page.json().get("products", []) if page.status_code == 200 else []
+    for product in rng.sample(products, min(3, len(products))):
+        await ctx.call("GET /api/products/{product_id}", "GET", f"/api/products/{product['id']}", key)
+
+
+async def workload_search(ctx: Context, rng: random.Random, user: dict):
+    key = user["api_key"]
+    word = rng.choice(WORDS)
+    await ctx.call("GET /api/search/ (fts)", "GET", "/api/search/", key, params={"query": word[:rng.randint(3, len(word))]})
+    await ctx.call("GET /api/search/ (fts, filtered)", "GET", "/api/search/", key,
+                   params={"query": f"{rng.choice(WORDS)} {rng.choice(WORDS)}", "category": rng.choice(CATEGORIES),
+                           "is_available": True})
+    await ctx.call("GET /api/search/ (substring)", "GET", "/api/search/", key,
+                   params={"query": word, "mode": "substring", "limit": 20})
+
+
+async def workload_orders(ctx: Context, rng: random.Random, user: dict):
+    key = user["api_key"]
+    ctx.order_counter += 1
+    order_id = f"bench-order-{user['id']}-{ctx.order_counter}"
+    # Položky s počty kusů - cenu i odečtení skladu řeší server v jednom požadavku
+    items = [{"product_id": product_id(rng.randrange(ctx.products)), "quantity": rng.randint(1, 3)}
+             for _ in range(rng.randint(1, 5))]
+    response = await ctx.call("POST /api/orders/", "POST", "/api/orders/", key, expected=(409,), json={
+        "id": order_id, "user_id": user["id"], "items": items, "status": "new"
+    })
+    if response.status_code != 200:
+        return
+    await ctx.call("GET /api/orders/{order_id}", "GET", f"/api/orders/{order_id}", key)
+    await ctx.call("PATCH /api/orders/{order_id}/status", "PATCH", f"/api/orders/{order_id}/status", key,
+                   params={"status": rng.choice(ORDER_TRANSITIONS)})
+    await ctx.call("GET /api/users/{user_id}/orders/", "GET", f"/api/users/{user['id']}/orders/", key,
+                   params={"limit": 50})
+
+
+async def workload_auth(ctx: Context, rng: random.Random, user: dict):
+    response = await ctx.call("POST /api/renew-api-key", "POST", "/api/renew-api-key",
+                              params={"current_api_key": user["api_key"]})
+    if response.status_code == 200:
+        user["api_key"] = response.json()["api_key"]
+    await ctx.call("GET /api/users/{user_id}", "GET", f"/api/users/{user['id']}", user["api_key"])
+    if rng.random() < 0.2:
+        response = await ctx.call("POST /api/auth-token", "POST", "/api/auth-token",
+                                  params={"email": user["email"], "token": user["token"]})
+        if response.status_code == 200:
+            user["api_key"] = response.json()["api_key"]
+
+
+WORKLOADS = {
+    "browse": workload_browse,
+    "search": workload_search,
+    "orders": workload_orders,
+    "auth": workload_auth,
+}
+
+
+async def seed(client: httpx.AsyncClient, products: int, users: int, seed_value: int) -> list:
+    rng = random.Random(seed_value)
+    seeded_users = []
+    for index in range(users):
+        user = {"id": f"bench-user-{index:04d}", "email": f"bench{index}@example.com"}
+        response = await client.post("/api/users/register", json={
+            "id": user["id"], "username": f"bench{index}", "email": user["email"], "full_name": f"Bench User {index}"
+        })
+        response.raise_for_status()
+        user["token"] = response.json()["token"]
+        response = await client.post("/api/auth-token", params={"email": user["email"], "token": user["token"]})
+        response.raise_for_status()
+        user["api_key"] = response.json()["api_key"]
+        seeded_users.append(user)
+
+    lines = []
+    for index in range(products):
+        name = f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} {index}"
+        lines.append(json.dumps({
+            "id": product_id(index), "name": name, "description": " ".join(rng.choices(WORDS, k=8)),
+            "price": round(rng.uniform(5, 2000), 2), "stock": rng.randint(0, 500),
+            "category": rng.choice(CATEGORIES), "is_available": rng.random() > 0.1
+        }, ensure_ascii=False))
+    response = await client.post("/api/products/import", content="\n".join(lines).encode(), timeout=600,
+                                 headers={"access_token": seeded_users[0]["api_key"],
+                                          "content-type": "application/x-ndjson"})
+    response.raise_for_status()
+    return seeded_users
+
+
+async def run_workload(ctx: Context, name: str, concurrency: int, iterations: int, seed_value: int) -> dict:
+    ctx.recorder = Recorder()
+    workload = WORKLOADS[name]
+
+    async def worker(worker_index: int):
+        rng = random.Random(f"{seed_value}-{name}-{worker_index}")
+        # Každý worker má vlastní uživatele, aby se obměna klíčů nepřekrývala
+        user = ctx.users[worker_index % len(ctx.users)]
+        for _ in range(iterations):
+            await workload(ctx, rng, user)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    duration = time.perf_counter() - started
+    endpoints = ctx.recorder.summary(duration)
+    return {
+        "duration_s": duration,
+        "requests": sum(item["requests"] for item in endpoints.values()),
+        "throughput": sum(item["requests"] for item in endpoints.values()) / duration,
+        "endpoints": endpoints,
+    }
+
+
+def print_report(results: dict, baseline: dict = None):
+    for name, workload in results["workloads"].items():
+        print(f"\n[{name}] {workload['requests']} requests in {workload['duration_s']:.2f} s "
+              f"({workload['throughput']:.1f} req/s)")
+        print(f"  {'endpoint':<42}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        base_endpoints = (baseline or {}).get("workloads", {}).get(name, {}).get("endpoints", {})
+        for label, item in workload["endpoints"].items():
+            line = (f"  {label:<42}{item['throughput']:10.1f}{item['p50_ms']:10.2f}"
+                    f"{item['p99_ms']:10.2f}{item['errors']:8d}")
+            base = base_endpoints.get(label)
+            if base and base["p50_ms"] and base["throughput"]:
+                line += (f"   req/s {(item['throughput'] / base['throughput'] - 1) * 100:+.0f}%,"
+                         f" p50 {(item['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%")
+            print(line)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main_async(args):
+    if args.url:
+        transport = None
+        base_url = args.url
+        app_module = None
+    else:
+        # Aplikace v procesu s vlastní databází v dočasném adresáři
+        os.environ["DB_MODE"] = args.db_mode
+        sys.path.insert(0, REPO_DIR)
+        os.chdir(tempfile.mkdtemp(prefix="ecommerce-load-"))
+        import main as app_module
+        # ASGI transport nespouští lifespan aplikace, schéma se proto vytvoří přímo
+        app_module.create_schema()
+        transport = httpx.ASGITransport(app=app_module.app)
+        base_url = "http://loadtest"
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=60, limits=limits) as client:
+        seed_started = time.perf_counter()
+        users = await seed(client, args.products, max(args.users, args.concurrency), args.seed)
+        print(f"Seeded {args.products} products and {len(users)} users in {time.perf_counter() - seed_started:.1f} s")
+
+        ctx = Context(client, Recorder(), args.products, users)
+        results = {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(),
+                "git_revision": git_revision(),
+                "target": args.url or f"in-process (DB_MODE={args.db_mode})",
+                "products": args.products,
+                "users": len(users),
+                "concurrency": args.concurrency,
+                "iterations": args.iterations,
+                "seed": args.seed,
+            },
+            "workloads": {},
+        }
+        for name in args.workloads:
+            # Krátké zahřátí, aby se do měření nepočítalo plnění cache
+            await run_workload(ctx, name, args.concurrency, 1, args.seed + 1)
+            results["workloads"][name] = await run_workload(ctx, name, args.concurrency, args.iterations, args.seed)
+
+    if app_module is not None:
+        app_module.log_writer.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running server; default runs the app in-process")
+    parser.add_argument("--db-mode", choices=["async", "sync"], default=os.getenv("DB_MODE", "async"),
+                        help="DB_MODE of the in-process app")
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=50, help="Iterations per worker and workload")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workloads", nargs="+", choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    args = parser.parse_args()
+    # Aplikace v procesu mění pracovní adresář - cesty k souborům se proto ustálí předem
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    results = asyncio.run(main_async(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResults written to {args.output}")
@@ -0,0 +1,116 @@
+"""Srovnání propustnosti GET /api/products/{id} s čistým ASGI LoggingMiddleware
+a s původní implementací nad BaseHTTPMiddleware.
+
+Spuštění z kořene repozitáře:
+    python benchmarks/middleware_benchmark.py --requests 5000 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+# Benchmark pracuje s vlastní dočasnou databází, aby nezasáhl do ecommerce.db
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(tempfile.mkdtemp(prefix="ecommerce-bench-"))
+
+import httpx
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import main
+
+
+# Původní middleware - odpověď prochází přes call_next a BaseHTTPMiddleware
+class LegacyLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        request_id = str(uuid.uuid4())
+        start_time = datetime.utcnow()
+        started = time.perf_counter()
+        api_key = request.headers.get(main.API_KEY_NAME)
+
+        response = await call_next(request)
+
+        duration = time.perf_counter() - started
+        status_code = response.status_code
+        main.request_metrics.observe(request.method, main.get_route_template(request.scope), status_code, duration)
+        await main.log_writer.enqueue({
+            "request_id": request_id,
+            "timestamp": start_time,
+            "method": request.method,
+            "path": request.url.path,
+            "status_code": status_code,
+            "client_ip": request.client.host,
+            "user_agent": request.headers.get("User-Agent"),
+            "api_key": main.hash_api_key(api_key) if api_key else "NO_API_KEY",
+            "is_successful": 200 <= status_code < 300,
+            "duration_ms": duration * 1000,
+        })
+        return response
+
+
+def use_middleware(middleware_class):
+    main.app.user_middleware = [Middleware(middleware_class)]
+    main.app.middleware_stack = main.app.build_middleware_stack()
+
+
+async def seed(client: httpx.AsyncClient) -> str:
+    user = await client.post("/api/users/register", json={
+        "id": "bench-user", "username": "bench", "email": "bench@example.com", "full_name": "Bench"
+    })
+    token = user.json()["token"]
+    api_key = (await client.post("/api/auth-token", params={"email": "bench@example.com", "token": token})).json()["api_key"]
+    await client.post("/api/products/", headers={main.API_KEY_NAME: api_key}, json={
+        "id": "bench-product", "name": "Pero", "description": "Modré pero", "price": 12.5, "stock": 100, "category": "Psaní"
+    })
+    return api_key
+
+
+async def run(client: httpx.AsyncClient, api_key: str, requests: int, concurrency: int) -> float:
+    headers = {main.API_KEY_NAME: api_key}
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            response = await client.get("/api/products/bench-product", headers=headers)
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return requests / (time.perf_counter() - started)
+
+
+async def benchmark(requests: int, concurrency: int, rounds: int):
+    # ASGI transport nespouští lifespan aplikace, schéma se proto vytvoří přímo
+    main.create_schema()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        api_key = await seed(client)
+        variants = [("BaseHTTPMiddleware", LegacyLoggingMiddleware), ("pure ASGI", main.LoggingMiddleware)]
+        results = {name: [] for name, _ in variants}
+        for _ in range(rounds):
+            for name, middleware_class in variants:
+                use_middleware(middleware_class)
+                await run(client, api_key, min(requests, 200), concurrency)  # zahřátí
+                results[name].append(await run(client, api_key, requests, concurrency))
+
+    main.log_writer.stop()
+    print(f"GET /api/products/{{id}}, {requests} requests, concurrency {concurrency}, best of {rounds}")
+    best = {name: max(values) for name, values in results.items()}
+    for name, value in best.items():
+        print(f"  {name:<20} {value:10.1f} req/s")
+    baseline = best["BaseHTTPMiddleware"]
+    print(f"  speedup              {best['pure ASGI'] / baseline:10.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.requests, args.concurrency, args.rounds))
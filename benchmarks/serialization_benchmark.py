@@ -0,0 +1,117 @@
+"""Mikrobenchmark serializace odpovědí - původní cesta (pydantic modely + validace přes
+response_model + JSONResponse) proti rychlé cestě (payload z ORM řádků + FastJSONResponse).
+
+Spuštění z kořene repozitáře:
+    python benchmarks/serialization_benchmark.py --items 100 --number 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Import main vytváří databázi v pracovním adresáři - použije se dočasný
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(tempfile.mkdtemp(prefix="ecommerce-bench-"))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+import main
+
+
+def find_route(path: str, method: str):
+    return next(route for route in main.app.routes
+                if getattr(route, "path", None) == path and method in getattr(route, "methods", ()))
+
+
+def make_products(count: int):
+    return [main.ProductDB(id=f"prod-{i:05d}", name=f"Produkt {i}", description="Kancelářské potřeby",
+                           price=10.0 + i, stock=i, category="Psaní", is_available=True) for i in range(count)]
+
+
+def make_orders(count: int):
+    created_at = datetime(2024, 1, 1, 12, 30)
+    orders = [main.OrderDB(id=f"order-{i:05d}", user_id="user-1", total_price=100.0 + i,
+                           status=main.OrderStatus.PROCESSING, created_at=created_at) for i in range(count)]
+    order_items = {order.id: [(f"prod-{j:05d}", j + 1) for j in range(5)] for order in orders}
+    return orders, order_items
+
+
+def old_list_products(field, products):
+    content = main.ProductList(total=len(products), products=[main.Product.from_orm(p) for p in products],
+                               skip=0, limit=len(products))
+    return JSONResponse(asyncio.run(serialize_response(field=field, response_content=content))).body
+
+
+def new_list_products(products):
+    return main.FastJSONResponse({"total": len(products), "products": [main.product_payload(p) for p in products],
+                                  "skip": 0, "limit": len(products), "next_cursor": None}).body
+
+
+def old_product_detail(field, product):
+    return JSONResponse(asyncio.run(serialize_response(field=field, response_content=product))).body
+
+
+def new_product_detail(product):
+    return main.FastJSONResponse(main.product_payload(product)).body
+
+
+def old_list_orders(field, orders, order_items):
+    content = [main.Order(id=o.id, user_id=o.user_id, products=[product_id for product_id, _ in order_items[o.id]],
+                          items=[main.OrderItem(product_id=product_id, quantity=quantity)
+                                 for product_id, quantity in order_items[o.id]], total_price=o.total_price,
+                          status=o.status, created_at=o.created_at) for o in orders]
+    return JSONResponse(asyncio.run(serialize_response(field=field, response_content=content))).body
+
+
+def new_list_orders(orders, order_items):
+    return main.FastJSONResponse([main.order_payload(o, order_items[o.id]) for o in orders]).body
+
+
+def measure(fn, number: int) -> float:
+    fn()  # zahřátí
+    started = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - started) / number * 1_000_000
+
+
+def benchmark(items: int, number: int):
+    products = make_products(items)
+    orders, order_items = make_orders(items)
+    list_field = find_route("/api/products/", "GET").response_field
+    detail_field = find_route("/api/products/{product_id}", "GET").response_field
+    orders_field = find_route("/api/users/{user_id}/orders/", "GET").response_field
+
+    cases = [
+        (f"GET /api/products/ ({items} items)",
+         lambda: old_list_products(list_field, products), lambda: new_list_products(products)),
+        ("GET /api/products/{product_id}",
+         lambda: old_product_detail(detail_field, products[0]), lambda: new_product_detail(products[0])),
+        (f"GET /api/users/{{user_id}}/orders/ ({items} items)",
+         lambda: old_list_orders(orders_field, orders, order_items), lambda: new_list_orders(orders, order_items)),
+    ]
+
+    # asyncio.run ve staré cestě má vlastní režii - odečte se změřená prázdná smyčka
+    async def noop():
+        return None
+    loop_overhead = measure(lambda: asyncio.run(noop()), number)
+
+    print(f"JSON encoder: {'orjson' if main.orjson is not None else 'json'}; times in µs per response")
+    print(f"{'endpoint':<46}{'old':>10}{'new':>10}{'speedup':>10}")
+    for name, old, new in cases:
+        old_time = measure(old, number) - loop_overhead
+        new_time = measure(new, number)
+        print(f"{name:<46}{old_time:10.1f}{new_time:10.1f}{old_time / new_time:9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--number", type=int, default=1000)
+    args = parser.parse_args()
+    benchmark(args.items, args.number)
@@ -0,0 +1,242 @@
+import argparse
+import bisect
+import itertools
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, event, text
+
+from main import (Base, ProductDB, UserDB, OrderDB, APIKeyDB, OrderStatus, order_products,
+                  setup_product_search, rebuild_product_search, run_migrations, setup_table_versions)
+
+# Předvolby velikosti (produkty, uživatelé, objednávky)
+SCALES = {
+    "small": (10_000, 1_000, 20_000),
+    "medium": (100_000, 10_000, 200_000),
+    "large": (1_000_000, 100_000, 2_000_000),
+    "xlarge": (5_000_000, 500_000, 10_000_000),
+}
+
+CATEGORIES = ["Psaní", "Papír", "Archivace", "Kancelářská technika", "Obálky", "Lepidla", "Sešívání",
+              "Školní potřeby", "Čisticí prostředky", "Občerstvení", "Nábytek", "Tonery a náplně"]
+NOUNS = ["pero", "tužka", "sešit", "pořadač", "obálka", "lepidlo", "sešívačka", "kalkulačka", "papír", "zvýrazňovač",
+         "fix", "blok", "desky", "šanon", "razítko", "pravítko", "guma", "ořezávátko", "toner", "židle"]
+ADJECTIVES = ["modrý", "černý", "červený", "barevný", "recyklovaný", "kancelářský", "školní", "kovový", "plastový",
+              "ekologický", "prémiový", "kompaktní"]
+STATUS_WEIGHTS = [(OrderStatus.NEW, 5), (OrderStatus.PROCESSING, 10), (OrderStatus.SHIPPED, 15),
+                  (OrderStatus.DELIVERED, 65), (OrderStatus.CANCELLED, 5)]
+
+
+# Kumulativní váhy Zipfova rozdělení - několik kategorií a produktů tvoří většinu prodejů
+def zipf_cum_weights(count: int, exponent: float) -> list:
+    return list(itertools.accumulate(1.0 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def weighted_index(rng: random.Random, cum_weights: list) -> int:
+    return bisect.bisect_left(cum_weights, rng.random() * cum_weights[-1])
+
+
+# Počet produktů v objednávce nebo kusů v položce - geometrické rozdělení se střední hodnotou `mean`
+def products_per_order(rng: random.Random, mean: float, maximum: int) -> int:
+    p = 1.0 / mean
+    return min(maximum, 1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - p)) if p < 1 else 1)
+
+
+class Generator:
+    def __init__(self, engine, seed: int, batch_size: int, prefix: str, now: datetime):
+        self.engine = engine
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.stats = {}
+        # Časy se počítají od pevného okamžiku (--now), aby byl výstup pro stejný seed shodný v kterýkoli den
+        self.now = now
+
+    def insert(self, table, rows):
+        # Vkládání po dávkách v jedné velké transakci na tabulku
+        started = time.perf_counter()
+        count = 0
+        with self.engine.begin() as conn:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    conn.execute(table.insert(), batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                conn.execute(table.insert(), batch)
+                count += len(batch)
+        duration = time.perf_counter() - started
+        self.stats[table.name] = (count, duration)
+        print(f"  {table.name:<15} {count:>12,} řádků za {duration:8.1f} s ({count / duration if duration else 0:,.0f} řádků/s)")
+
+    def product_rows(self, count: int, categories: list, category_weights: list):
+        rng = self.rng
+        self.product_ids = []
+        self.product_prices = []
+        for index in range(count):
+            product_id = f"{self.prefix}-prod-{index:08d}"
+            price = round(math.exp(rng.gauss(4.5, 1.0)), 2)  # log-normální cena, medián cca 90 Kč
+            created_at = self.now - timedelta(days=rng.uniform(0, 3 * 365))
+            self.product_ids.append(product_id)
+            self.product_prices.append(price)
+            noun = rng.choice(NOUNS)
+            yield {
+                "id": product_id,
+                "name": f"{rng.choice(ADJECTIVES).capitalize()} {noun} {index}",
+                "description": f"{rng.choice(ADJECTIVES).capitalize()} {noun} - " + " ".join(rng.choices(NOUNS, k=6)),
+                "price": price,
+                "stock": int(rng.expovariate(1 / 80)),
+                "category": categories[weighted_index(rng, category_weights)],
+                "is_available": rng.random() < 0.95,
+                "created_at": created_at,
+                "updated_at": created_at,
+            }
+
+    def user_rows(self, count: int):
+        rng = self.rng
+        self.user_ids = []
+        for index in range(count):
+            user_id = f"{self.prefix}-user-{index:08d}"
+            created_at = self.now - timedelta(days=rng.uniform(0, 3 * 365))
+            self.user_ids.append(user_id)
+            yield {
+                "id": user_id,
+                "username": f"{self.prefix}_user_{index}",
+                "email": f"{self.prefix}.user{index}@example.com",
+                "full_name": f"Uživatel {index}",
+                "token": f"{rng.getrandbits(192):048x}",
+                "is_activated": rng.random() < 0.98,
+                "created_at": created_at,
+                "updated_at": created_at,
+            }
+
+    def api_key_rows(self, keys_per_user: int):
+        rng = self.rng
+        for user_index, user_id in enumerate(self.user_ids):
+            # Starší klíče jsou neaktivní, poslední je platný - s daleko vzdálenou expirací, aby šel
+            # použít proti API i při pevném --now v minulosti
+            for key_index in range(keys_per_user):
+                is_last = key_index == keys_per_user - 1
+                yield {
+                    "id": f"{self.prefix}-key-{user_index:08d}-{key_index}",
+                    "user_id": user_id,
+                    "key": f"{rng.getrandbits(256):064x}",
+                    "is_active": is_last,
+                    "expires_at": self.now + timedelta(days=3650) if is_last
+                    else self.now - timedelta(days=rng.uniform(1, 365)),
+                }
+
+    def order_rows(self, count: int, days: int, user_weights: list, product_weights: list,
+                   mean_products: float, max_products: int, mean_quantity: float):
+        rng = self.rng
+        self.order_links = []
+        statuses = [status for status, _ in STATUS_WEIGHTS]
+        status_weights = list(itertools.accumulate(weight for _, weight in STATUS_WEIGHTS))
+        for index in range(count):
+            order_id = f"{self.prefix}-order-{index:09d}"
+            line_count = products_per_order(rng, mean_products, max_products)
+            product_indexes = {weighted_index(rng, product_weights) for _ in range(line_count)}
+            created_at = self.now - timedelta(seconds=rng.uniform(0, days * 86400))
+            total_price = 0.0
+            for product_index in product_indexes:
+                quantity = products_per_order(rng, mean_quantity, 100)
+                total_price += self.product_prices[product_index] * quantity
+                self.order_links.append({"order_id": order_id, "product_id": self.product_ids[product_index],
+                                         "quantity": quantity})
+            yield {
+                "id": order_id,
+                "user_id": self.user_ids[weighted_index(rng, user_weights)],
+                "total_price": round(total_price, 2),
+                "status": statuses[weighted_index(rng, status_weights)].name,
+                "created_at": created_at,
+                "updated_at": created_at,
+            }
+
+
+def generate(args):
+    engine = create_engine(args.database)
+
+    # Rychlé nastavení pouze pro toto hromadné plnění
+    @event.listens_for(engine, "connect")
+    def set_bulk_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -200000")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        cursor.close()
+
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    # Triggery fulltextu a verzí by zpomalily vkládání - index se po naplnění sestaví najednou
+    with engine.begin() as conn:
+        for trigger in ("products_fts_ai", "products_fts_ad", "products_fts_au",
+                        "products_version_ai", "products_version_au", "products_version_ad",
+                        "product_categories_version_ai", "product_categories_version_au",
+                        "product_categories_version_ad"):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+
+    products, users, orders = SCALES[args.scale]
+    products = args.products if args.products is not None else products
+    users = args.users if args.users is not None else users
+    orders = args.orders if args.orders is not None else orders
+    print(f"Generování dat do {args.database} (seed={args.seed}): "
+          f"{products:,} produktů, {users:,} uživatelů, {orders:,} objednávek")
+
+    generator = Generator(engine, args.seed, args.batch_size, args.prefix, args.now)
+    categories = (CATEGORIES * (args.categories // len(CATEGORIES) + 1))[:args.categories]
+    categories = [name if index < len(CATEGORIES) else f"{name} {index // len(CATEGORIES)}"
+                  for index, name in enumerate(categories)]
+    started = time.perf_counter()
+
+    generator.insert(ProductDB.__table__, generator.product_rows(products, categories,
+                                                                 zipf_cum_weights(len(categories), args.category_skew)))
+    generator.insert(UserDB.__table__, generator.user_rows(users))
+    generator.insert(APIKeyDB.__table__, generator.api_key_rows(args.keys_per_user))
+
+    # Objednávky na uživatele - silně nerovnoměrné (několik velkých B2B účtů), popularita produktů podle Zipfa
+    user_weights = list(itertools.accumulate(generator.rng.lognormvariate(0.0, args.user_skew) for _ in range(users)))
+    product_weights = zipf_cum_weights(products, args.product_skew)
+    generator.insert(OrderDB.__table__, generator.order_rows(orders, args.days, user_weights, product_weights,
+                                                             args.products_per_order, args.max_products_per_order,
+                                                             args.quantity_per_item))
+    generator.insert(order_products, generator.order_links)
+
+    index_started = time.perf_counter()
+    setup_product_search(engine)
+    rebuild_product_search(engine)
+    setup_table_versions(engine)
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE table_versions SET version = version + 1"))
+    print(f"  {'products_fts':<15} index sestaven za {time.perf_counter() - index_started:8.1f} s")
+
+    duration = time.perf_counter() - started
+    total = sum(count for count, _ in generator.stats.values())
+    print(f"Celkem {total:,} řádků za {duration:.1f} s ({total / duration:,.0f} řádků/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generátor syntetických dat pro e-shop API (přímý zápis do DB)")
+    parser.add_argument("--database", default="sqlite:///./ecommerce.db", help="SQLAlchemy URL cílové databáze")
+    parser.add_argument("--scale", choices=list(SCALES), default="small", help="Předvolba velikosti")
+    parser.add_argument("--products", type=int, help="Počet produktů (přepíše předvolbu)")
+    parser.add_argument("--users", type=int, help="Počet uživatelů (přepíše předvolbu)")
+    parser.add_argument("--orders", type=int, help="Počet objednávek (přepíše předvolbu)")
+    parser.add_argument("--categories", type=int, default=len(CATEGORIES))
+    parser.add_argument("--category-skew", type=float, default=1.1, help="Exponent Zipfova rozdělení kategorií")
+    parser.add_argument("--product-skew", type=float, default=0.9, help="Exponent Zipfova rozdělení popularity produktů")
+    parser.add_argument("--user-skew", type=float, default=1.0, help="Sigma log-normálního rozdělení objednávek na uživatele")
+    parser.add_argument("--products-per-order", type=float, default=3.0, help="Průměrný počet produktů v objednávce")
+    parser.add_argument("--max-products-per-order", type=int, default=50)
+    parser.add_argument("--quantity-per-item", type=float, default=1.5, help="Průměrný počet kusů jedné položky")
+    parser.add_argument("--keys-per-user", type=int, default=2)
+    parser.add_argument("--days", type=int, default=365, help="Rozpětí data vytvoření objednávek ve dnech")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--now", type=datetime.fromisoformat, default=datetime(2024, 1, 1),
+                        help="Okamžik, od kterého se počítají časy dat (ISO 8601, UTC)")
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--prefix", default="gen", help="Předpona ID, aby se data nepřekrývala s existujícími")
+    generate(parser.parse_args())
@@ -0,0 +1,35 @@
+import argparse
+import sys
+
+from sqlalchemy import create_engine, select
+
+from main import schema_migrations, configure_sqlite_engine, create_schema, explain_hot_queries
+
+
+def migrate(args) -> int:
+    engine = create_engine(args.database)
+    configure_sqlite_engine(engine)
+    # Schéma, migrace, fulltext a triggery verzí - běží jednou před startem workerů aplikace
+    applied = create_schema(engine)
+    with engine.connect() as conn:
+        version = conn.scalar(select(schema_migrations.c.version).order_by(schema_migrations.c.version.desc()).limit(1))
+    print(f"Databáze {args.database}: verze schématu {version}"
+          + (f", provedeno: {', '.join(applied)}" if applied else ", žádné nové migrace"))
+
+    # Kontrola plánů dotazů nad aktuálním schématem
+    problems = 0
+    for entry in explain_hot_queries(engine):
+        flags = [flag for flag in ("full_scan", "temp_sort", "wrong_index") if entry[flag]]
+        problems += bool(flags)
+        print(f"  {'CHYBA' if flags else 'OK':<6} {entry['query']:<30} {' | '.join(entry['plan'])}"
+              + (f"  [{', '.join(flags)}; očekáván {entry['index']}]" if flags else ""))
+    if problems:
+        print(f"{problems} dotazů prochází celou tabulku, řadí mimo index nebo nepoužívá očekávaný index")
+    return 1 if problems and args.check else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrace schématu databáze a kontrola plánů dotazů")
+    parser.add_argument("--database", default="sqlite:///./ecommerce.db", help="SQLAlchemy URL databáze")
+    parser.add_argument("--check", action="store_true", help="Skončit s chybou, pokud některý dotaz prochází celou tabulku nebo nepoužívá očekávaný index")
+    sys.exit(migrate(parser.parse_args()))
@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Každý test nad vlastní databází v dočasném adresáři
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "database", None)
+    with TestClient(main.create_app(init_schema=True)) as client:
+        user = client.post("/api/users/register", json={
+            "id": "user-1", "username": "user-1", "email": "user-1@example.com", "full_name": "User"
+        }).json()
+        api_key = client.post("/api/auth-token", params={"email": "user-1@example.com", "token": user["token"]}).json()["api_key"]
+        client.headers["access_token"] = api_key
+        client.post("/api/products/", json={
+            "id": "pen-1", "name": "Pero", "description": "Modré", "price": 10, "stock": 10, "category": "Psaní"
+        })
+        yield client
+
+
+def create_order(client, order_id, quantity, **fields):
+    response = client.post("/api/orders/", json={
+        "id": order_id, "user_id": "user-1", "items": [{"product_id": "pen-1", "quantity": quantity}], **fields
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+def stock(client):
+    return client.get("/api/products/pen-1").json()["stock"]
+
+
+def set_status(client, order_id, status):
+    return client.patch(f"/api/orders/{order_id}/status", params={"status": status})
+
+
+def test_repeated_cancel_releases_stock_once(client):
+    create_order(client, "order-1", 3)
+    assert stock(client) == 7
+
+    assert set_status(client, "order-1", "cancelled").status_code == 200
+    assert stock(client) == 10
+    assert set_status(client, "order-1", "cancelled").status_code == 200
+    assert stock(client) == 10
+
+    # Zrušená objednávka je konečná - nejde ji obnovit a zrušit znovu
+    assert set_status(client, "order-1", "new").status_code == 409
+    assert set_status(client, "order-1", "cancelled").status_code == 200
+    assert stock(client) == 10
+
+
+def test_concurrent_cancels_release_stock_once(client):
+    create_order(client, "order-1", 2)
+    assert stock(client) == 8
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(lambda _: set_status(client, "order-1", "cancelled"), range(4)))
+
+    assert all(response.status_code in (200, 409) for response in responses)
+    assert stock(client) == 10
+    assert client.get("/api/orders/order-1").json()["status"] == "cancelled"
+
+
+def test_batch_cancel_after_single_cancel_releases_stock_once(client):
+    create_order(client, "order-1", 4)
+    assert set_status(client, "order-1", "cancelled").status_code == 200
+
+    report = client.post("/api/orders/status-transitions", json={"status": "cancelled", "order_ids": ["order-1"]}).json()
+    assert report["unchanged"] == 1
+    assert stock(client) == 10
+
+
+def test_created_order_always_starts_as_new(client):
+    order = create_order(client, "order-1", 5, status="cancelled")
+    assert order["status"] == "new"
+
+    assert set_status(client, "order-1", "cancelled").status_code == 200
+    assert stock(client) == 10